@@ -21,20 +21,21 @@
 
 import sys
 import gzip
+import hashlib
+import io
+import os
 import csv
+import pandas as pd
 import xml.etree.ElementTree as ET
-#import tqdm
-import io
 import argparse
+import functools
+import random
 import time
 
-from Bio import Entrez, SeqIO
-from pprint import pprint
-from datetime import datetime
-from collections import Counter, defaultdict
-from urllib.error import HTTPError
-
-import sys
+from Bio import Entrez
+from collections import defaultdict
+from http.client import HTTPException
+from urllib.error import HTTPError, URLError
 
 
 # TODO
@@ -52,31 +53,169 @@ def parse_args(args=None):
     parser.add_argument('-ta', "--taxa_assemblies", required=True, metavar='FILE', type=argparse.FileType('w'), help="Output file containing: taxon_id, assembly_id.")
     parser.add_argument('-ep', "--entities_proteins", required=True, metavar='FILE', type=argparse.FileType('w'), help="Output file containing: protein_tmp_id, entity_name (taxon_id).")
     parser.add_argument('-me', "--microbiomes_entities", required=True, metavar='FILE', type=argparse.FileType('w'), help="Output file containing: entity_name (taxon_id), microbiome_id, entity_weight.")
+    parser.add_argument('-b', "--batch_size", metavar='N', type=int, default=200, help="Number of proteins to download per Entrez request (default: 200).")
+    parser.add_argument('-c', "--cache_dir", metavar='DIR', help="Optional directory to cache Entrez results in (for up to 24 h), including the protein summaries and sequences (cached per batch of protein UIDs), allowing reruns with identical queries to skip the download.")
     return parser.parse_args(args)
 
 
-# get assembly length ("total_length") from entrez
-def get_assembly_length(assemblyId):
-    success = False
-    for attempt in range(3):
-        try:
-            with Entrez.efetch(db="assembly", rettype="docsum", id=assemblyId) as entrez_handle:
-                assembly_stats = Entrez.read(entrez_handle, validate=False)
-            time.sleep(1)   # avoid getting blocked by ncbi
-            success = True
-            break
-        except HTTPError as err:
-            if 500 <= err.code <= 599:
-                print("Received error from server %s" % err)
-                print("Attempt %i of 3" % attempt)
-                time.sleep(10)
-            else:
-                raise
-    if not success:
-        sys.exit("Entrez efetch download failed!")
+class IncompleteResultError(RuntimeError):
+    pass
 
-    root = ET.fromstring("<root>" + str(assembly_stats['DocumentSummarySet']['DocumentSummary'][0]['Meta']) + "</root>")
-    return root.find("./Stats/Stat[@category='total_length'][@sequence_tag='all']").text
+
+# retry entrez requests on server errors (5xx), rate limiting (429), network errors (also while reading the response) and incomplete results, using exponential backoff
+def retry_entrez(func, max_attempts=5, max_wait=30):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(1, max_attempts + 1):
+            try:
+                return func(*args, **kwargs)
+            except HTTPError as err:
+                if not (err.code == 429 or 500 <= err.code <= 599):
+                    raise
+                print("Received error from server %s" % err)
+            except (URLError, HTTPException, OSError) as err:
+                print("Network error %r" % err)
+            except IncompleteResultError as err:
+                print("Incomplete result: %s" % err)
+            if attempt < max_attempts:
+                wait = min(2 ** attempt, max_wait) + random.uniform(0, 1)
+                print("Attempt %i of %i failed, retrying in %.1f s" % (attempt, max_attempts, wait))
+                time.sleep(wait)
+        sys.exit(f"Entrez download failed ({func.__name__})!")
+    return wrapper
+
+
+# maximum age of cached entrez results, older results are downloaded again
+CACHE_MAX_AGE = 24 * 60 * 60   # seconds
+
+
+# get path of the cache file for a query (None if caching is disabled)
+def get_cache_file(cache_dir, query, suffix=".xml"):
+    if cache_dir is None:
+        return None
+    return os.path.join(cache_dir, hashlib.sha1(repr(query).encode()).hexdigest() + suffix)
+
+
+# load raw XML result from cache, returns None if not cached or expired
+def load_cache(cache_file):
+    if cache_file is None or not os.path.isfile(cache_file) or time.time() - os.path.getmtime(cache_file) > CACHE_MAX_AGE:
+        return None
+    with open(cache_file, 'rb') as cache_handle:
+        return cache_handle.read()
+
+
+# store raw XML result in cache
+def store_cache(cache_file, data):
+    if cache_file is None:
+        return
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    # write to temporary file first to avoid leaving incomplete results in the cache
+    with open(cache_file + ".tmp", 'wb') as cache_handle:
+        cache_handle.write(data)
+    os.replace(cache_file + ".tmp", cache_file)
+
+
+# run entrez query and return raw XML result
+@retry_entrez
+def entrez_download(entrez_func, **kwargs):
+    with entrez_func(**kwargs) as entrez_handle:
+        data = entrez_handle.read()
+    if isinstance(data, str):
+        data = data.encode()
+    return data
+
+
+# run entrez query (or load it from cache_dir) and parse complete XML result
+# NOTE results are only cached after they were parsed successfully, e.g. to not cache NCBI error messages
+def entrez_read(entrez_func, cache_dir=None, validate=True, **kwargs):
+    cache_file = get_cache_file(cache_dir, (entrez_func.__name__, sorted(kwargs.items())))
+    data = load_cache(cache_file)
+    if data is not None:
+        return Entrez.read(io.BytesIO(data), validate=validate)
+    data = entrez_download(entrez_func, **kwargs)
+    result = Entrez.read(io.BytesIO(data), validate=validate)
+    store_cache(cache_file, data)
+    return result
+
+
+# run entrez query (or load it from cache_dir) and parse XML result iteratively, yielding one record (e.g. LinkSet) at a time
+def entrez_parse(entrez_func, cache_dir=None, validate=True, **kwargs):
+    cache_file = get_cache_file(cache_dir, (entrez_func.__name__, sorted(kwargs.items())))
+    data = load_cache(cache_file)
+    if data is not None:
+        yield from Entrez.parse(io.BytesIO(data), validate=validate)
+        return
+    data = entrez_download(entrez_func, **kwargs)
+    yield from Entrez.parse(io.BytesIO(data), validate=validate)
+    store_cache(cache_file, data)
+
+
+# XPath to the total assembly length within the 'Meta' field of an assembly docsum
+TOTAL_LENGTH_XPATH = "./Stats/Stat[@category='total_length'][@sequence_tag='all']"
+
+
+# get assembly lengths ("total_length") from entrez, using batched esummary requests
+def get_assembly_lengths(assemblyIds, cache_dir=None, batch_size=500):
+    dict_assemblyId_length = {}
+    for start in range(0, len(assemblyIds), batch_size):
+        batch = assemblyIds[start:start + batch_size]
+        assembly_stats = entrez_read(Entrez.esummary, cache_dir, validate=False, db="assembly", id=",".join(batch))
+
+        for assembly_summary in assembly_stats['DocumentSummarySet']['DocumentSummary']:
+            # 'Meta' contains an XML fragment, which is parsed once per assembly
+            meta = ET.fromstring(f"<root>{assembly_summary['Meta']}</root>")
+            dict_assemblyId_length[assembly_summary.attributes['uid']] = meta.findtext(TOTAL_LENGTH_XPATH)
+
+    return dict_assemblyId_length
+
+
+# download (or load from cache_dir) summaries and FASTA records for a batch of protein UIDs
+# NOTE the cache is keyed on the UIDs of the batch, so that reruns do not need to download the proteins again
+@retry_entrez
+def download_protein_batch(proteinIds, cache_dir=None):
+    summary_cache_file = get_cache_file(cache_dir, ("protein_esummary", proteinIds))
+    fasta_cache_file = get_cache_file(cache_dir, ("protein_efetch", proteinIds), suffix=".fasta")
+
+    summary_data = load_cache(summary_cache_file)
+    summary_cached = summary_data is not None
+    if not summary_cached:
+        summary_data = entrez_download(Entrez.esummary, db="protein", id=",".join(proteinIds))
+    dict_protein_uid_acc = { protein_summary["Id"] : protein_summary["AccessionVersion"] for protein_summary in Entrez.read(io.BytesIO(summary_data)) }
+
+    # FASTA records are downloaded completely, so that a retry does not lead to duplicates
+    fasta_data = load_cache(fasta_cache_file)
+    fasta_cached = fasta_data is not None
+    if not fasta_cached:
+        fasta_data = entrez_download(Entrez.efetch, db="protein", rettype="fasta", retmode="text", id=",".join(proteinIds))
+    records = list(parse_fasta(io.StringIO(fasta_data.decode())))
+
+    # check that the results are complete, i.e. contain exactly the requested proteins (only complete results are cached)
+    if set(dict_protein_uid_acc) != set(proteinIds):
+        raise IncompleteResultError(f"received {len(dict_protein_uid_acc)} protein summaries for {len(proteinIds)} proteins")
+    if len(records) != len(proteinIds) or set(seqId for seqId, seq in records) != set(dict_protein_uid_acc.values()):
+        raise IncompleteResultError(f"received {len(records)} FASTA records for {len(proteinIds)} proteins")
+
+    if not summary_cached:
+        store_cache(summary_cache_file, summary_data)
+    if not fasta_cached:
+        store_cache(fasta_cache_file, fasta_data)
+    return dict_protein_uid_acc, records
+
+
+# parse FASTA records from handle, yielding (id, sequence) tuples
+def parse_fasta(handle):
+    seqId = None
+    seq_lines = []
+    for line in handle:
+        if line.startswith(">"):
+            if seqId is not None:
+                yield seqId, "".join(seq_lines)
+            seqId = line[1:].split(None, 1)[0]
+            seq_lines = []
+        else:
+            seq_lines.append(line.strip())
+    if seqId is not None:
+        yield seqId, "".join(seq_lines)
 
 
 
@@ -84,25 +223,35 @@ def main(args=None):
     args = parse_args(args)
 
     # setup entrez email
+    # NOTE Bio.Entrez itself spaces out requests according to NCBI's rate limit (10 requests/s with an API key),
+    # so no additional sleeps are needed between successful requests
     Entrez.api_key = args.key
     Entrez.email = args.email
+    # disable internal retries of Bio.Entrez, retries (with backoff) are handled by retry_entrez
+    Entrez.max_tries = 1
 
     # read taxonomic ids for download (together with abundances) and write 'microbiomes_entities' output
     taxIds = []
-    print("entity_name", "microbiome_id", "entity_weight", sep='\t', file=args.microbiomes_entities)
+    microbiomes_entities = []
     for taxid_input, microbiomeId in zip(args.taxid_input, args.microbiome_ids):
-        reader = csv.DictReader(taxid_input, delimiter='\t')
-        for row in reader:
-            taxIds.append(row['taxon_id'])
-            try:
-                print(row['taxon_id'], microbiomeId, row['abundance'], sep='\t', file=args.microbiomes_entities, flush=True)
-            except KeyError:
-                try:
-                    print(row['taxon_id'], microbiomeId, 1, sep='\t', file=args.microbiomes_entities, flush=True)
-                except KeyError:
-                    sys.exit(f"The format of the input file '{taxid_input.name}' is invalid!")
-
-    taxIds = list(set(taxIds))
+        # abundances are optional, parse them once here
+        # NOTE missing values (as recognized by pandas, e.g. 'NA', '#N/A') are written out empty,
+        # microbiomes without any weights get uniform weights downstream
+        try:
+            taxa = pd.read_csv(taxid_input, sep='\t', dtype={'taxon_id': str})
+            abundances = pd.to_numeric(taxa['abundance']) if 'abundance' in taxa.columns else [1.0] * len(taxa)
+            for taxId, abundance in zip(taxa['taxon_id'], abundances):
+                taxIds.append(taxId)
+                microbiomes_entities.append((taxId, microbiomeId, None if pd.isnull(abundance) else abundance))
+        except (KeyError, ValueError):
+            sys.exit(f"The format of the input file '{taxid_input.name}' is invalid!")
+
+    writer = csv.writer(args.microbiomes_entities, delimiter='\t', lineterminator='\n')
+    writer.writerow(["entity_name", "microbiome_id", "entity_weight"])
+    writer.writerows(microbiomes_entities)
+    args.microbiomes_entities.flush()
+
+    taxIds = sorted(set(taxIds))
     print("Processing the following taxonmy IDs:")
     print(taxIds)
 
@@ -111,42 +260,27 @@ def main(args=None):
     print("# taxa: ", len(taxIds))
     print("for each taxon retrieve assembly IDs ...")
 
-    success = False
-    for attempt in range(3):
-        try:
-            with Entrez.elink(dbfrom="taxonomy", db="assembly", LinkName="taxonomy_assembly", id=taxIds) as entrez_handle:
-                assembly_results = Entrez.read(entrez_handle)
-            time.sleep(1)   # avoid getting blocked by ncbi
-            success = True
-            break
-        except HTTPError as err:
-            if 500 <= err.code <= 599:
-                print("Received error from server %s" % err)
-                print("Attempt %i of 3" % attempt)
-                time.sleep(10)
-            else:
-                raise
-    if not success:
-        sys.exit("Entrez elink download failed!")
+    assembly_results = entrez_read(Entrez.elink, args.cache_dir, dbfrom="taxonomy", db="assembly", LinkName="taxonomy_assembly", id=taxIds)
 
     # 2) for each taxon -> select one assembly (largest for now)
     print("get assembly lengths and select largest assembly for each taxon ...")
+    all_assemblyIds = sorted({ assembly_record["Id"] for tax_record in assembly_results if len(tax_record["LinkSetDb"]) > 0 for assembly_record in tax_record["LinkSetDb"][0]["Link"] })
+    dict_assemblyId_length = get_assembly_lengths(all_assemblyIds, args.cache_dir)
     dict_taxId_assemblyId = {}
     for tax_record in assembly_results:
         taxId = tax_record["IdList"][0]
         if len(tax_record["LinkSetDb"]) > 0:
             # get all assembly ids
             ids = [ assembly_record["Id"] for assembly_record in tax_record["LinkSetDb"][0]["Link"] ]
-            # get corresponding lengths
-            lengths = [get_assembly_length(id) for id in ids]
-            # get id for largest assembly
-            selected_assemblyId = ids[lengths.index(max(lengths))]
+            # get id for largest assembly (lengths are compared as integers)
+            selected_assemblyId = max(ids, key=lambda id: int(dict_assemblyId_length[id]))
             dict_taxId_assemblyId[taxId] = selected_assemblyId
 
     # write taxId - assemblyId out
-    print("taxon_id", "assembly_id", sep='\t', file=args.taxa_assemblies, flush=True)
-    for taxId in dict_taxId_assemblyId.keys():
-            print(taxId, dict_taxId_assemblyId[taxId], sep='\t', file=args.taxa_assemblies, flush=True)
+    writer = csv.writer(args.taxa_assemblies, delimiter='\t', lineterminator='\n')
+    writer.writerow(["taxon_id", "assembly_id"])
+    writer.writerows(dict_taxId_assemblyId.items())
+    args.taxa_assemblies.flush()
 
     # 3) (selected) assembly -> nucleotide sequences
     # (maybe split here)
@@ -154,30 +288,22 @@ def main(args=None):
     print("# selected assemblies: ", len(assemblyIds))
     print("for each assembly get nucloetide sequence IDs...")
 
-    success = False
-    for attempt in range(3):
-        try:
-            with Entrez.elink(dbfrom="assembly", db="nuccore", LinkName="assembly_nuccore_refseq", id=assemblyIds) as entrez_handle:
-                nucleotide_results = Entrez.read(entrez_handle)
-            time.sleep(1)   # avoid getting blocked by ncbi
-            success = True
-            break
-        except HTTPError as err:
-            if 500 <= err.code <= 599:
-                print("Received error from server %s" % err)
-                print("Attempt %i of 3" % attempt)
-                time.sleep(10)
-            else:
-                raise
-    if not success:
-            sys.exit("Entrez elink download failed!")
+    nucleotide_results = entrez_parse(Entrez.elink, args.cache_dir, dbfrom="assembly", db="nuccore", LinkName="assembly_nuccore_refseq", id=list(assemblyIds))
 
     ### for each assembly get list of sequence ids
-    dict_seqId_assemblyIds = defaultdict(lambda : [])
+    dict_seqId_assemblyIds = defaultdict(list)
+    skipped_assemblyIds = []
     for assembly_record in nucleotide_results:
         assemblyId = assembly_record["IdList"][0]
-        for record in assembly_record["LinkSetDb"][0]["Link"]:
-            dict_seqId_assemblyIds[record["Id"]].append(assemblyId)
+        if len(assembly_record["LinkSetDb"]) > 0:
+            for record in assembly_record["LinkSetDb"][0]["Link"]:
+                dict_seqId_assemblyIds[record["Id"]].append(assemblyId)
+        else:
+            skipped_assemblyIds.append(assemblyId)
+
+    if skipped_assemblyIds:
+        print("WARNING: no RefSeq nucleotide sequences linked to the following assemblies, their taxa will have no proteins:")
+        print(skipped_assemblyIds)
 
     print("# nucleotide sequences (unique): ", len(dict_seqId_assemblyIds.keys()))
     # -> # contigs
@@ -185,37 +311,16 @@ def main(args=None):
     # 4) nucelotide sequences -> proteins
     print("for each nucleotide sequence get proteins ...")
 
-    success = False
-    for attempt in range(3):
-        try:
-            with Entrez.elink(dbfrom="nuccore", db="protein", LinkName="nuccore_protein", id=list(dict_seqId_assemblyIds.keys())) as entrez_handle:
-                protein_results = Entrez.read(entrez_handle)
-            time.sleep(1)   # avoid getting blocked by ncbi
-            success = True
-            break
-        except HTTPError as err:
-            if 500 <= err.code <= 599:
-                print("Received error from server %s" % err)
-                print("Attempt %i of 3" % attempt)
-                time.sleep(10)
-            else:
-                raise
-    if not success:
-            sys.exit("Entrez elink download failed!")
+    protein_results = entrez_parse(Entrez.elink, args.cache_dir, dbfrom="nuccore", db="protein", LinkName="nuccore_protein", id=list(dict_seqId_assemblyIds.keys()))
 
     ### for each nucleotide sequence get list of protein ids
-    dict_proteinId_assemblyIds = {}
+    dict_proteinId_assemblyIds = defaultdict(set)
     for nucleotide_record in protein_results:
         seqId = nucleotide_record["IdList"][0]
         assemblyIds = dict_seqId_assemblyIds[seqId]
         if len(nucleotide_record["LinkSetDb"]) > 0:
             for protein_record in nucleotide_record["LinkSetDb"][0]["Link"]:
-                if protein_record["Id"] not in dict_proteinId_assemblyIds:
-                    dict_proteinId_assemblyIds[protein_record["Id"]] = assemblyIds
-                else:
-                    for i in assemblyIds:
-                        if i not in dict_proteinId_assemblyIds[protein_record["Id"]]:
-                            dict_proteinId_assemblyIds[protein_record["Id"]].append(i)
+                dict_proteinId_assemblyIds[protein_record["Id"]].update(assemblyIds)
 
     # NOTE:
     # some proteins, such as 487413233, occur within multiple sequences of the assembly!
@@ -228,65 +333,32 @@ def main(args=None):
 
     # 5) download protein FASTAs, convert to TSV
     print("    download proteins ...")
-    # (or if mem problem: assembly-wise)
-    # TODO check if max. number of item that can be returned by efetch (retmax)!? compare numbers!
-
-    # first retrieve mapping for protein UIDs and accession versions
-    success = False
-    for attempt in range(3):
-        try:
-            with Entrez.esummary(db="protein", id=",".join(proteinIds)) as entrez_handle:   # esummary doesn't work on python lists somehow
-                protein_summaries = Entrez.read(entrez_handle)
-            time.sleep(1)   # avoid getting blocked by ncbi
-            success = True
-            break
-        except HTTPError as err:
-            if 500 <= err.code <= 599:
-                print("Received error from server %s" % err)
-                print("Attempt %i of 3" % attempt)
-                time.sleep(10)
-            else:
-                raise
-    if not success:
-            sys.exit("Entrez esummary download failed!")
 
+    # retrieve protein summaries and FASTA records batch-wise to avoid truncated results and overly long requests
     dict_protein_uid_acc = {}
-    for protein_summary in protein_summaries:
-        dict_protein_uid_acc[protein_summary["Id"]] = protein_summary["AccessionVersion"]
-
-    # download actual fasta records and write out
-    success = False
-    for attempt in range(3):
-        try:
-            with Entrez.efetch(db="protein", rettype="fasta", retmode="text", id=proteinIds) as entrez_handle:
-                with gzip.open(args.proteins, 'wt') as out_handle:
-                    print("protein_tmp_id", "protein_sequence", sep='\t', file=out_handle)
-                    for record in SeqIO.parse(entrez_handle, "fasta"):
-                        print(record.id, record.seq, sep='\t', file=out_handle, flush=True)
-            time.sleep(1)   # avoid getting blocked by ncbi
-            success = True
-            break
-        except HTTPError as err:
-            if 500 <= err.code <= 599:
-                print("Received error from server %s" % err)
-                print("Attempt %i of 3" % attempt)
-                time.sleep(10)
-            else:
-                raise
-    if not success:
-            sys.exit("Entrez efetch download failed!")
+    with gzip.open(args.proteins, 'wt') as out_handle:
+        print("protein_tmp_id", "protein_sequence", sep='\t', file=out_handle)
+        for start in range(0, len(proteinIds), args.batch_size):
+            print("    batch", start // args.batch_size + 1, "of", (len(proteinIds) - 1) // args.batch_size + 1)
+            batch_uid_acc, records = download_protein_batch(proteinIds[start:start + args.batch_size], args.cache_dir)
+            dict_protein_uid_acc.update(batch_uid_acc)
+            for seqId, seq in records:
+                out_handle.write(f"{seqId}\t{seq}\n")
 
     # 6) write out 'entities_proteins.entrez.tsv'
-    print("protein_tmp_id", "entity_name", sep='\t', file=args.entities_proteins)
-    dict_assemblyId_taxId = { v : k for k, v in dict_taxId_assemblyId.items() }
-    if len(dict_assemblyId_taxId) != len(dict_taxId_assemblyId):
-        sys.exit("Creation of dict_assemblyId_taxId failed!")
-    for proteinId in proteinIds:
-        accVersion = dict_protein_uid_acc[proteinId]
-        # write out protein_tmp_id, entity_name (taxon_id)
-        for assemblyId in dict_proteinId_assemblyIds[proteinId]:
-            taxId = dict_assemblyId_taxId[assemblyId]
-            print(accVersion, taxId, sep='\t', file=args.entities_proteins, flush=True)
+    # NOTE the same assembly might be selected for multiple taxa (e.g. for a species and one of its strains)
+    proteins_assemblies = pd.DataFrame([ (proteinId, assemblyId) for proteinId, assemblyIds in dict_proteinId_assemblyIds.items() for assemblyId in sorted(assemblyIds) ], columns=["protein_uid", "assembly_id"])
+    entities_assemblies = pd.DataFrame(list(dict_taxId_assemblyId.items()), columns=["entity_name", "assembly_id"])
+    # NOTE left merge to keep the order of the proteins (an inner merge would group them by assembly)
+    entities_proteins = proteins_assemblies.merge(entities_assemblies, on="assembly_id", how="left")
+    # write out protein_tmp_id, entity_name (taxon_id)
+    entities_proteins["protein_tmp_id"] = entities_proteins["protein_uid"].map(dict_protein_uid_acc)
+    if entities_proteins["protein_tmp_id"].isnull().any():
+        missing = entities_proteins.loc[entities_proteins["protein_tmp_id"].isnull(), "protein_uid"].unique()
+        sys.exit(f"No accession version retrieved for {len(missing)} protein(s), e.g. {', '.join(missing[:5])}!")
+    if entities_proteins["entity_name"].isnull().any():
+        sys.exit("Mapping proteins to entities failed!")
+    entities_proteins[["protein_tmp_id", "entity_name"]].to_csv(args.entities_proteins, sep="\t", index=False)
 
     # NOTE for proteins the NCBI accession version ids are written out to enable a mapping to the fasta/tsv output
     # in contrast, for assemblies UIDs are written out
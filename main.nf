@@ -29,6 +29,7 @@ def helpMessage() {
       --prodigal_mode [str]           Prodigal mode, 'meta' or 'single'. Default: 'meta'.
       --ncbi_key [str]                NCBI key for faster download from Entrez databases.
       --ncbi_email [str]              Email address for NCBI Entrez database access. Required if downloading proteins from NCBI.
+      --ncbi_cache_dir [str]          Directory to cache NCBI Entrez query results in (for up to 24 h), including the downloaded protein sequences, allowing reruns with identical taxa to skip the download. When using containers, the directory must be mounted into the container.
       --min_pep_len [int]             Min. peptide length to generate.
       --max_pep_len [int]             Max. peptide length to generate.
       --pred_method [str]             Epitope prediction method to use. One of [syfpeithi, mhcflurry, mhcnuggets-class-1, mhcnuggets-class-2]. Default: syfpeithi.
@@ -120,6 +121,7 @@ if (workflow.revision) summary['Pipeline Release'] = workflow.revision
 summary['Run Name']         = custom_runName ?: workflow.runName
 summary['Input']            = params.input
 summary['Prodigal mode']    = params.prodigal_mode
+if (params.ncbi_cache_dir) summary['NCBI cache dir'] = params.ncbi_cache_dir
 summary['Min. peptide length']   = params.min_pep_len
 summary['Max. peptide length']   = params.max_pep_len
 summary['Peptide Subsampling'] = params.sample_n ? "$params.sample_n per condition" : "disabled"
@@ -362,6 +364,7 @@ process download_proteins {
     script:
     def key = params.ncbi_key
     def email = params.ncbi_email
+    def cache_dir = params.ncbi_cache_dir ? "--cache_dir ${file(params.ncbi_cache_dir)}" : ""
     def microbiome_ids = microbiome_ids.join(' ')
     """
     # provide new home dir to avoid permission errors with Docker and other artefacts
@@ -373,7 +376,8 @@ process download_proteins {
                                 -p proteins.entrez.tsv.gz \
                                 -ta taxa_assemblies.tsv \
                                 -ep entities_proteins.entrez.tsv \
-                                -me microbiomes_entities.entrez.tsv
+                                -me microbiomes_entities.entrez.tsv \
+                                $cache_dir
     """
 }
 